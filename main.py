@@ -1,24 +1,49 @@
+from collections import OrderedDict
 import csv
 import datetime
 from enum import Enum
+import functools
+import hashlib
+import io
+import itertools
 import logging
+from logging.handlers import WatchedFileHandler
+import os
 from pathlib import Path
-from typing import Any, Optional, List, Union
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, List, Tuple
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 import oracledb
+import orjson
 from pydantic import BaseModel, Field
 from pydantic.error_wrappers import ValidationError
 
+import config
 from config import USER, PASSWORD
 
 oracledb.defaults.config_dir = "."
+# rows fetched per round trip by queries that return many rows; set in config.py to tune for the
+# network
+FETCH_ARRAYSIZE = getattr(config, "FETCH_ARRAYSIZE", 10000)
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(filename="api.log", level=logging.DEBUG)
+# In production, several worker processes write to api.log, and a file can't safely be rotated
+# by more than one process, so it is rotated outside the app (e.g. by logrotate). Each worker
+# reopens the log when it has been moved.
+# basicConfig() ignores its handlers if logging is already configured (e.g. when this module is
+# imported again), so only create one when it isn't, and don't open the file until it's needed.
+if not logging.root.handlers:
+    logging.basicConfig(
+        level=logging.DEBUG,
+        handlers=[WatchedFileHandler("api.log", delay=True)],
+    )
 
 # The field names in the Pydantic models below are the ones in the database.
 # They may be changed, to value in `alias`.
@@ -68,6 +93,12 @@ class CountKind(str, Enum):
     no_data = "count data not in database"
 
 
+def _orjson_dumps(v: Any, *, default: Any) -> str:
+    """Serialize to JSON with orjson, for the models' .json(), which is much faster than json."""
+    # orjson returns bytes, but pydantic expects a str
+    return orjson.dumps(v, default=default).decode()
+
+
 class Count(BaseModel):
     COUNTDATE: datetime.date = Field(alias="date")
     AM12: Optional[int]
@@ -111,9 +142,8 @@ class Record(BaseModel):
     COUNTERID: Optional[str] = Field(alias="counter_id")
     STATIONID: Optional[str] = Field(alias="station_id")
     count_type: Optional[CountKind]
-    TYPE: Optional[
-        Union[BicycleCountKind, PedestrianCountKind, VehicleCountKind, NotInDatabaseCountKind]
-    ] = Field(alias="count_sub_type")
+    # one of the values of the *CountKind enums; get_record() classifies it by those
+    TYPE: Optional[str] = Field(alias="count_sub_type")
     DESCRIPTION: Optional[str] = Field(alias="description")
     SETDATE: Optional[datetime.date] = Field(alias="set_date")
     PRJ: Optional[str] = Field(alias="project")
@@ -160,12 +190,50 @@ class Record(BaseModel):
     # this allows extracting by db field name, but using alias
     class Config:
         allow_population_by_field_name = True
+        json_dumps = _orjson_dumps
 
 
 class Error(BaseModel):
     message: str
 
 
+class RecordNotFoundError(Exception):
+    """Raised when there is no record with the requested number."""
+
+
+class TTLCache:
+    """
+    A thread-safe cache of at most `maxsize` items, each of which expires `ttl` seconds after it
+    was added. When full, the least recently used item is dropped.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: OrderedDict[Any, Tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        """Get the item for `key`, or None if there isn't one or it has expired."""
+        with self._lock:
+            try:
+                expires, value = self._items[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
 app = FastAPI(
     title="DVRPC Traffic Counts API",
     description="Please visit [Travel Monitoring Counts](https://www.dvrpc.org/traffic/) for "
@@ -181,6 +249,154 @@ app.add_middleware(
     allow_methods=["GET"],
     allow_headers=["*"],
 )
+# records (as JSON or CSV) are mostly repetitive numbers, so compress all but small responses
+# The fastest level already gets most of the reduction in size for such data.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
+
+# the TYPEs of the counts in each CountKind, and the query for their record numbers
+count_kind_types = {
+    CountKind.bicycle: [each.value for each in BicycleCountKind],
+    CountKind.pedestrian: [each.value for each in PedestrianCountKind],
+    CountKind.vehicle: [each.value for each in VehicleCountKind],
+    CountKind.no_data: [each.value for each in NotInDatabaseCountKind],
+}
+record_numbers_sql = {
+    kind: "select RECORDNUM from DVRPCTC.TC_HEADER where type in ({})".format(
+        ",".join(":" + str(i + 1) for i in range(len(count_types)))
+    )
+    for kind, count_types in count_kind_types.items()
+}
+
+# the CountKind of each TYPE, and the table of individual counts for the kinds that share one
+count_kind_by_type: Dict[Optional[str], CountKind] = {
+    count_type: kind for kind, count_types in count_kind_types.items() for count_type in count_types
+}
+hourly_count_tables = {
+    CountKind.bicycle: "DVRPCTC.TC_BIKECOUNT",
+    CountKind.pedestrian: "DVRPCTC.TC_PEDCOUNT",
+}
+
+# The counts database is updated periodically rather than continuously, so records are reused for
+# a few minutes instead of being fetched from the database for every request.
+record_cache = TTLCache(maxsize=1024, ttl=300)
+
+# connections to the database are shared between requests, rather than one being opened for each
+pool: oracledb.ConnectionPool
+
+
+@app.on_event("startup")
+def create_pool() -> None:
+    global pool
+    pool = oracledb.create_pool(
+        user=USER,
+        password=PASSWORD,
+        dsn="dvrpcprod_tp_tls",
+        min=2,
+        max=20,
+        increment=1,
+        # requests wait for a free connection when all are busy, which bounds the load on the
+        # database, but only for a while (ms), as a CSV download holds its connection until the
+        # client has received it all; connections idle for a minute beyond `min` are closed
+        getmode=oracledb.POOL_GETMODE_TIMEDWAIT,
+        wait_timeout=10_000,
+        timeout=60,
+        # every statement is one of a fixed set of constant SQL strings (those in
+        # record_numbers_sql and counts_sql are built once, at import), so all of them stay in
+        # each connection's statement cache and are only parsed once per connection
+        stmtcachesize=40,
+    )
+
+
+@app.on_event("shutdown")
+def close_pool() -> None:
+    pool.close()
+
+
+# the hour of the day (as formatted by Oracle's HH24) to its field in Count
+am_pm_map = {
+    "00": "AM12",
+    "01": "AM1",
+    "02": "AM2",
+    "03": "AM3",
+    "04": "AM4",
+    "05": "AM5",
+    "06": "AM6",
+    "07": "AM7",
+    "08": "AM8",
+    "09": "AM9",
+    "10": "AM10",
+    "11": "AM11",
+    "12": "PM12",
+    "13": "PM1",
+    "14": "PM2",
+    "15": "PM3",
+    "16": "PM4",
+    "17": "PM5",
+    "18": "PM6",
+    "19": "PM7",
+    "20": "PM8",
+    "21": "PM9",
+    "22": "PM10",
+    "23": "PM11",
+}
+
+# The queries for individual counts below return the columns of Count, in the order of its fields
+# and already of its types, so Counts can be constructed from them without validation.
+# TC_BIKECOUNT and TC_PEDCOUNT can have several rows per hour. Total them by hour, with one row
+# per day and one column per hour, plus the total for the day (only if all 24 hours of it were
+# counted), and add the day's weather.
+hourly_counts_sql = """
+    SELECT c.*, w.WEATHER, TO_CHAR(w.HIGHTEMP) AS HIGHTEMP, TO_CHAR(w.LOWTEMP) AS LOWTEMP
+    FROM (
+        SELECT
+            TO_CHAR(COUNTDATE, 'YYYY-MM-DD') AS COUNTDATE,
+            {hours},
+            CASE
+                WHEN COUNT(DISTINCT TO_CHAR(COUNTTIME, 'HH24')) = 24 THEN SUM(total)
+            END AS TOTALCOUNT
+        FROM {{tc_table}}
+        WHERE dvrpcnum = :num
+        GROUP BY COUNTDATE
+    ) c
+    LEFT JOIN DVRPCTC.TC_WEATHER w ON w.COUNTDATE = TO_DATE(c.COUNTDATE, 'YYYY-MM-DD')
+    ORDER BY c.COUNTDATE
+""".format(
+    hours=",\n            ".join(
+        f"SUM(CASE WHEN TO_CHAR(COUNTTIME, 'HH24') = '{hour}' THEN total END) AS {field}"
+        for hour, field in am_pm_map.items()
+    )
+)
+
+# TC_VOLCOUNT is already totalled by hour, with the same columns as Count; add the day's weather
+volume_counts_sql = """
+    SELECT
+        TO_CHAR(v.COUNTDATE, 'YYYY-MM-DD') AS COUNTDATE,
+        {hours},
+        v.TOTALCOUNT,
+        w.WEATHER,
+        TO_CHAR(w.HIGHTEMP) AS HIGHTEMP,
+        TO_CHAR(w.LOWTEMP) AS LOWTEMP
+    FROM DVRPCTC.TC_VOLCOUNT v
+    LEFT JOIN DVRPCTC.TC_WEATHER w ON w.COUNTDATE = TRUNC(v.COUNTDATE)
+    WHERE v.RECORDNUM = :num
+""".format(hours=", ".join(f"v.{field}" for field in am_pm_map.values()))
+
+# the query for the individual counts of each kind of count that has them in the database
+counts_sql: Dict[Optional[CountKind], str] = {
+    **{
+        kind: hourly_counts_sql.format(tc_table=tc_table)
+        for kind, tc_table in hourly_count_tables.items()
+    },
+    CountKind.vehicle: volume_counts_sql,
+}
+
+# the CSV headers of a record's metadata and of its counts, which are the models' field aliases
+# The "counts" field isn't part of the metadata - that is written separately.
+csv_fieldnames_metadata = [field for field in Record.schema()["properties"] if field != "counts"]
+csv_fieldnames_count = list(Count.schema()["properties"])
+
+# CSVs are saved in csv/ after they're first created, and served from there afterwards
+Path("csv").mkdir(exist_ok=True)
 
 responses = {
     400: {"model": Error, "description": "Bad Request"},
@@ -189,197 +405,331 @@ responses = {
 }
 
 
+def _dict_rowfactory(cursor: oracledb.Cursor) -> None:
+    """Have `cursor` return rows as dictionaries keyed by column name."""
+    # <https://python-oracledb.readthedocs.io/en/latest/user_guide/sql_execution.html#rowfactories>
+    columns = tuple(col[0] for col in cursor.description)
+    cursor.rowfactory = lambda *args: dict(zip(columns, args))
+
+
+def _fetch_many_rows(cursor: oracledb.Cursor) -> None:
+    """Have `cursor` fetch many rows per round trip, for queries that return many rows."""
+    # prefetching one more row than arraysize means a query returning no more than that many rows
+    # needs no extra round trip to find that there aren't any more
+    cursor.arraysize = FETCH_ARRAYSIZE
+    cursor.prefetchrows = FETCH_ARRAYSIZE + 1
+
+
+def get_metadata(connection: oracledb.Connection, num: int) -> Optional[Record]:
+    """Get a record's metadata, without its individual counts."""
+    with connection.cursor() as cursor:
+        # only one row is expected, which the default prefetchrows (2) already fetches along with
+        # the query, so don't size fetches for more
+        cursor.arraysize = 1
+
+        # get overall count metadata, along with the names of its MCD
+        cursor.execute(
+            """
+            SELECT
+                h.*,
+                m.MCDNAME AS "municipality",
+                m.COUNTY AS "county",
+                m.STATE AS "state"
+            FROM DVRPCTC.TC_HEADER h
+            LEFT JOIN DVRPCTC.TC_MCD m ON m.DVRPC = h.MCD
+            WHERE h.RECORDNUM = :num
+        """,
+            num=num,
+        )
+
+        # convert tuple to dictionary
+        _dict_rowfactory(cursor)
+        record_data = cursor.fetchone()
+
+    if record_data is None:
+        return None
+
+    try:
+        record = Record(**record_data)
+    except ValidationError:
+        raise
+
+    # map SOURCE to human-readable version
+    if record.SOURCE:
+        if record.SOURCE == "0":
+            record.SOURCE = "DVRPC"
+        elif record.SOURCE == "-1":
+            record.SOURCE = "external"
+
+    record.count_type = count_kind_by_type.get(record.TYPE)
+
+    if record.count_type == CountKind.no_data:
+        # these are not in the database but just in static pdf
+        # the subtype in the url is just the value of TYPE without spaces
+        sub_type_in_url = str(record.TYPE).replace(" ", "")
+        record.static_pdf = (
+            f"https://www.dvrpc.org/asp/TrafficCountPDF/{sub_type_in_url}/{record.RECORDNUM}.PDF"
+        )
+
+    return record
+
+
+def iter_count_batches(
+    connection: oracledb.Connection, record: Record
+) -> Iterator[List[Tuple[Any, ...]]]:
+    """
+    Get the individual counts of a record (which must be of a kind in `counts_sql`) in batches,
+    as they are fetched from the database.
+
+    Each count is a tuple of the values of a Count, in the order of its fields.
+    """
+    with connection.cursor() as cursor:
+        # a count can span many days
+        _fetch_many_rows(cursor)
+
+        cursor.execute(counts_sql[record.count_type], num=record.RECORDNUM)
+
+        # the rows are already shaped like a Count, so they're passed on as they are, a round
+        # trip's worth (FETCH_ARRAYSIZE) at a time
+        while batch := cursor.fetchmany():
+            yield batch
+
+
 def get_record(num: int) -> Optional[Record]:
-    am_pm_map = {
-        "00": "AM12",
-        "01": "AM1",
-        "02": "AM2",
-        "03": "AM3",
-        "04": "AM4",
-        "05": "AM5",
-        "06": "AM6",
-        "07": "AM7",
-        "08": "AM8",
-        "09": "AM9",
-        "10": "AM10",
-        "11": "AM11",
-        "12": "PM12",
-        "13": "PM1",
-        "14": "PM2",
-        "15": "PM3",
-        "16": "PM4",
-        "17": "PM5",
-        "18": "PM6",
-        "19": "PM7",
-        "20": "PM8",
-        "21": "PM9",
-        "22": "PM10",
-        "23": "PM11",
-    }
+    """Get a record, reusing it if it was fetched from the database within the last few minutes."""
+    record = record_cache.get(num)
+    if record is None:
+        record = get_record_from_database(num)
+        # don't cache missing records, so new ones show up immediately
+        if record is not None:
+            record_cache.set(num, record)
+    return record
 
-    with oracledb.connect(user=USER, password=PASSWORD, dsn="dvrpcprod_tp_tls") as connection:
-        with connection.cursor() as cursor:
-            # get overall count metadata
-            cursor = connection.cursor()
-            cursor.execute("select * from DVRPCTC.TC_HEADER where RECORDNUM = :num", num=num)
 
-            # convert tuple to dictionary
-            # <https://python-oracledb.readthedocs.io/en/latest/user_guide/sql_execution.html#rowfactories>
-            columns = [col[0] for col in cursor.description]
-            cursor.rowfactory = lambda *args: dict(zip(columns, args))
-            record_data = cursor.fetchone()
+def get_record_from_database(num: int) -> Optional[Record]:
+    with pool.acquire() as connection:
+        record = get_metadata(connection, num)
 
-            if record_data is None:
-                return None
+        if record is not None and record.count_type in counts_sql:
+            record.counts = [
+                Count.construct(**dict(zip(Count.__fields__, row)))
+                for batch in iter_count_batches(connection, record)
+                for row in batch
+            ]
 
-            try:
-                record = Record(**record_data)
-            except ValidationError:
+    return record
+
+
+def handle_errors(fetch: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Make `fetch` return the error response for a missing or invalid record, or for no database
+    connection being free, rather than raise.
+    """
+
+    @functools.wraps(fetch)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        try:
+            return fetch(*args, **kwargs)
+        except RecordNotFoundError:
+            return JSONResponse(status_code=404, content={"message": "Record not found"})
+        except ValidationError as e:
+            logger.error(e)
+            return JSONResponse(status_code=500, content={"message": "Unexpected data type found."})
+        except oracledb.DatabaseError as e:
+            # DPY-4005: all of the pool's connections stayed busy for its wait_timeout
+            (error,) = e.args
+            if error.full_code != "DPY-4005":
                 raise
+            logger.warning(e)
+            return JSONResponse(
+                status_code=503,
+                content={"message": "Server busy, try again later."},
+                headers={"Retry-After": "10"},
+            )
 
-            # map SOURCE to human-readable version
-            if record.SOURCE:
-                if record.SOURCE == "0":
-                    record.SOURCE = "DVRPC"
-                elif record.SOURCE == "-1":
-                    record.SOURCE = "external"
-
-            # get MCD names
-            if record.MCD:
-                cursor.execute(
-                    "select MCDNAME, COUNTY, STATE from DVRPCTC.TC_MCD where DVRPC = :mcd",
-                    mcd=record.MCD,
-                )
-
-                columns = [col[0] for col in cursor.description]
-                cursor.rowfactory = lambda *args: dict(zip(columns, args))
-                mcd_data = cursor.fetchone()
-
-                if mcd_data:
-                    record.municipality = mcd_data["MCDNAME"]
-                    record.county = mcd_data["COUNTY"]
-                    record.state = mcd_data["STATE"]
-
-            # Get individual counts of the overall count
-
-            # TC_BIKECOUNT and TC_PEDCOUNT tables have same structure
-            if record.TYPE in (
-                [each.value for each in BicycleCountKind]
-                + [each.value for each in PedestrianCountKind]
-            ):
-                if record.TYPE in [each.value for each in BicycleCountKind]:
-                    tc_table = "DVRPCTC.TC_BIKECOUNT"
-                    record.count_type = CountKind.bicycle
-
-                if record.TYPE in [each.value for each in PedestrianCountKind]:
-                    tc_table = "DVRPCTC.TC_PEDCOUNT"
-                    record.count_type = CountKind.pedestrian
-
-                cursor.execute(
-                    f"""
-                    SELECT
-                        TO_CHAR(COUNTDATE, 'YYYY-MM-DD') as count_date,
-                        TO_CHAR(COUNTTIME, 'HH24') as HOUR,
-                        SUM(total) AS total
-                    FROM {tc_table}
-                    WHERE dvrpcnum = :num
-                    GROUP BY COUNTDATE, TO_CHAR( COUNTTIME, 'HH24')
-                    ORDER BY COUNTDATE, TO_CHAR( COUNTTIME, 'HH24')
-                """,
-                    num=num,
-                )
-
-                columns = [col[0] for col in cursor.description]
-                cursor.rowfactory = lambda *args: dict(zip(columns, args))
-                count_data = cursor.fetchall()
-
-                # that returns a list of dicts in the form
-                # {countdate, hour, total}
-                # create an intermediate dict of dicts to combine all hours/total by date
-                # {date: { am1, am2, ... pm12 ... pm11, total}}
-
-                counts = {}  # type: ignore
-
-                if count_data:
-                    for row in count_data:
-                        # create new entry if it doesn't yet exist
-                        if not counts.get(row["COUNT_DATE"]):
-                            counts[row["COUNT_DATE"]] = {}
-
-                        # populate the total by hour
-                        for k, v in am_pm_map.items():
-                            if row["HOUR"] == k:
-                                counts[row["COUNT_DATE"]][v] = row["TOTAL"]
-
-                    # sum total by day, get weather and temps
-                    for count_date, count in counts.items():
-                        # do not provide a total if there isn't a full day's count
-                        if len(count.items()) != 24:
-                            counts[count_date]["total"] = None
-                        # otherwise, sum them and put into `counts`
-                        else:
-                            total = 0
-                            for k2, v2 in count.items():
-                                total += v2
-
-                            counts[count_date]["total"] = total
-
-                        cursor.execute(
-                            """
-                            SELECT * FROM DVRPCTC.TC_WEATHER
-                            WHERE COUNTDATE = TO_DATE(:count_date, 'yyyy-mm-dd')
-                        """,
-                            count_date=count_date,
-                        )
-
-                        columns = [col[0] for col in cursor.description]
-                        cursor.rowfactory = lambda *args: dict(zip(columns, args))
-                        weather_count = cursor.fetchone()
-
-                        if weather_count:
-                            counts[count_date]["weather"] = weather_count["WEATHER"]
-                            counts[count_date]["high_temp"] = weather_count["HIGHTEMP"]
-                            counts[count_date]["low_temp"] = weather_count["LOWTEMP"]
-
-                # change this dict of dicts into list of Counts and add to record
-                record.counts = [Count(COUNTDATE=k, **v) for k, v in counts.items()]
-
-            # TC_VOLCOUNT has a different structure
-            # There's no reshaping here because it's already the same as Count
-            elif record.TYPE in [each.value for each in VehicleCountKind]:
-                record.count_type = CountKind.vehicle
-                cursor.execute("select * from DVRPCTC.TC_VOLCOUNT where RECORDNUM = :num", num=num)
-                columns = [col[0] for col in cursor.description]
-                cursor.rowfactory = lambda *args: dict(zip(columns, args))
-                count_data = cursor.fetchall()
-
-                if count_data:
-                    for row in count_data:
-                        cursor.execute(
-                            """
-                            SELECT * FROM DVRPCTC.TC_WEATHER
-                            WHERE COUNTDATE = TO_DATE(:count_date, 'yyyy-mm-dd')
-                        """,
-                            count_date=row["COUNTDATE"],
-                        )
-
-                        columns = [col[0] for col in cursor.description]
-                        cursor.rowfactory = lambda *args: dict(zip(columns, args))
-                        weather_count = cursor.fetchone()
-
-                        if weather_count:
-                            row["weather"] = weather_count["WEATHER"]
-                            row["high_temp"] = weather_count["HIGHTEMP"]
-                            row["low_temp"] = weather_count["LOWTEMP"]
-                        record.counts.append(Count(**row))
-            elif record.TYPE in [each.value for each in NotInDatabaseCountKind]:
-                # these are not in the database but just in static pdf
-                record.count_type = CountKind.no_data
-                # the subtype in the url is just the value of TYPE without spaces
-                sub_type_in_url = record.TYPE.value.replace(" ", "")
-                record.static_pdf = f"https://www.dvrpc.org/asp/TrafficCountPDF/{sub_type_in_url}/{record.RECORDNUM}.PDF"
+    return wrapper
 
-    return record
+
+def iter_record_csv(
+    record: Record, count_batches: Iterable[List[Tuple[Any, ...]]]
+) -> Iterator[str]:
+    """
+    Yield the CSV version of a record in chunks, with `count_batches` (as from
+    iter_count_batches()) as its individual counts.
+
+    Metadata is in the first two rows, followed by a blank line, followed by the data from the
+    count.
+    """
+    buffer = io.StringIO()
+
+    def flush() -> str:
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    # create a writer for the metadata and add it
+    writer = csv.DictWriter(buffer, fieldnames=csv_fieldnames_metadata, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerow(record.dict(by_alias=True, exclude={"counts"}))
+    yield flush()
+
+    # Create new writer, just to write an empty line
+    csv.writer(buffer).writerow("")
+    yield flush()
+
+    # create a new writer for the actual count data
+    # The counts are written as they come from the database, without building Counts from them.
+    count_writer = csv.writer(buffer)
+    count_writer.writerow(csv_fieldnames_count)
+    yield flush()
+    # write them a batch at a time, so the csv module handles the rows of each in one call
+    for batch in count_batches:
+        count_writer.writerows(batch)
+        yield flush()
+
+
+def save_record_csv(csv_file: Path, chunks: Iterable[str]) -> Iterator[str]:
+    """Yield the `chunks` of a CSV, saving a copy of them to `csv_file`."""
+    # write to a temporary file first, so a partially-written CSV is never served
+    fd, tmp_file = tempfile.mkstemp(dir=csv_file.parent, suffix=".tmp")
+    try:
+        with open(fd, "w", newline="") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_file, csv_file)
+    finally:
+        # if the response didn't finish (e.g. the client disconnected), discard the partial copy
+        Path(tmp_file).unlink(missing_ok=True)
+
+
+def stream_record_csv(csv_file: Path, num: int) -> Iterator[str]:
+    """
+    Yield the CSV version of a record, saving a copy to `csv_file`.
+
+    The record's metadata and then its counts, as they are fetched, come from the same
+    connection, unless the record is already cached. Nothing is yielded if there is no such
+    record.
+    """
+    record = record_cache.get(num)
+    if record is not None:
+        # it was fetched recently (e.g. to show its JSON first), so it only needs formatting
+        counts = [tuple(count.dict().values()) for count in record.counts]
+        yield from save_record_csv(csv_file, iter_record_csv(record, [counts]))
+        return
+
+    with pool.acquire() as connection:
+        record = get_metadata(connection, num)
+        if record is None:
+            return
+
+        # only a batch of counts is held at a time, however many there are
+        count_batches: Iterable[List[Tuple[Any, ...]]] = []
+        if record.count_type in counts_sql:
+            count_batches = iter_count_batches(connection, record)
+
+        yield from save_record_csv(csv_file, iter_record_csv(record, count_batches))
+
+
+@handle_errors
+def fetch_record_numbers(count_type: Optional[CountKind]) -> List[int]:
+    """Get the record numbers of all counts, or of only those of `count_type`."""
+    with pool.acquire() as connection:
+        with connection.cursor() as cursor:
+            # this can return every record
+            _fetch_many_rows(cursor)
+
+            if not count_type:
+                cursor.execute("select RECORDNUM from DVRPCTC.TC_HEADER")
+            else:
+                count_types = count_kind_types[count_type]
+                cursor.execute(record_numbers_sql[count_type], count_types)
+
+            # each row is a 1-tuple; flatten them into a list of record numbers
+            records = list(itertools.chain.from_iterable(cursor))
+
+    return records
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """
+    Check if an If-None-Match header matches `etag`: if it is "*" or lists `etag`, compared weakly
+    (i.e. ignoring any "W/" prefix), as RFC 9110 requires for If-None-Match.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque_tag(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return any(opaque_tag(tag) == opaque_tag(etag) for tag in if_none_match.split(","))
+
+
+@handle_errors
+def fetch_record_json(num: int, if_none_match: Optional[str]) -> Response:
+    """
+    Get the response for a record in JSON format, or a 304 response if the client's copy
+    (identified by `if_none_match`) is still current.
+    """
+    record = get_record(num)
+    if record is None:
+        raise RecordNotFoundError
+
+    # let clients (and any caches in between) revalidate the record rather than download it again
+    # The ETag is weak because GZipMiddleware may compress the body without changing it.
+    content = record.json(by_alias=True)
+    headers = {
+        "ETag": f'W/"{hashlib.blake2b(content.encode(), digest_size=16).hexdigest()}"',
+        "Cache-Control": "public, max-age=60",
+    }
+    if etag_matches(headers["ETag"], if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    # return a Response directly, so FastAPI doesn't validate the record a second time against
+    # `response_model` (which is kept for the documentation)
+    return Response(content=content, headers=headers, media_type="application/json")
+
+
+@handle_errors
+def fetch_record_csv(num: int, if_none_match: Optional[str]) -> Response:
+    """
+    Get the response for a record in CSV format, or a 304 response if the client's copy
+    (identified by `if_none_match`) is still current.
+    """
+    csv_file = Path(f"csv/{num}.csv")
+
+    # one stat() both checks for a saved copy and gets what its ETag needs
+    try:
+        stat = csv_file.stat()
+    except FileNotFoundError:
+        pass
+    else:
+        # let clients (and any caches in between) revalidate the file rather than download it again
+        # (with a weak ETag, as for JSON, since the body may be compressed)
+        headers = {
+            "ETag": f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+            "Cache-Control": "public, max-age=60",
+        }
+        if etag_matches(headers["ETag"], if_none_match):
+            return Response(status_code=304, headers=headers)
+        return FileResponse(csv_file, headers=headers, stat_result=stat, filename=csv_file.name)
+
+    # otherwise, fetch the record from the database, streaming its counts as they're fetched
+    # Its metadata is fetched for the first chunk, so errors can still be returned instead.
+    chunks = stream_record_csv(csv_file, num)
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        raise RecordNotFoundError
+
+    return StreamingResponse(
+        itertools.chain([first_chunk], chunks),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{csv_file.name}"'},
+    )
 
 
 @app.get(
@@ -394,35 +744,7 @@ def get_record_numbers(count_type: Optional[CountKind] = None):
     Optionally provide the `count_type` query parameter to get record numbers for specific types of
     counts, e.g. `?count_type=bicycle`.
     """
-    with oracledb.connect(user=USER, password=PASSWORD, dsn="dvrpcprod_tp_tls") as connection:
-        with connection.cursor() as cursor:
-            cursor = connection.cursor()
-
-            if not count_type:
-                cursor.execute("select RECORDNUM from DVRPCTC.TC_HEADER")
-            else:
-                if count_type == CountKind.bicycle:
-                    count_types = [each.value for each in BicycleCountKind]
-                elif count_type == CountKind.pedestrian:
-                    count_types = [each.value for each in PedestrianCountKind]
-                elif count_type == CountKind.vehicle:
-                    count_types = [each.value for each in VehicleCountKind]
-                elif count_type == CountKind.no_data:
-                    count_types = [each.value for each in NotInDatabaseCountKind]
-
-                bind_names = ",".join(":" + str(i + 1) for i in range(len(count_types)))
-                cursor.execute(
-                    f"select RECORDNUM from DVRPCTC.TC_HEADER where type in ({bind_names})",
-                    count_types,
-                )
-
-            res = cursor.fetchall()
-
-    records = []
-    for row in res:
-        records.append(row[0])
-
-    return records
+    return fetch_record_numbers(count_type)
 
 
 @app.get(
@@ -431,16 +753,8 @@ def get_record_numbers(count_type: Optional[CountKind] = None):
     response_model=Record,
     summary="Get count data in JSON format",
 )
-def get_record_json(num: int) -> Any:
-    try:
-        record = get_record(num)
-    except ValidationError:
-        return JSONResponse(status_code=500, content={"message": "Unexpected data type found."})
-
-    if record is None:
-        return JSONResponse(status_code=404, content={"message": "Record not found"})
-
-    return record
+def get_record_json(num: int, if_none_match: Optional[str] = Header(None)) -> Any:
+    return fetch_record_json(num, if_none_match)
 
 
 @app.get(
@@ -449,51 +763,9 @@ def get_record_json(num: int) -> Any:
     response_model=Record,
     summary="Get count data in a CSV file",
 )
-def get_record_csv(num: int) -> Any:
+def get_record_csv(num: int, if_none_match: Optional[str] = Header(None)) -> Any:
     """
     Metadata will be placed in the first two rows, followed by a blank line, followed by the
     data from the count.
     """
-    # create csv/ folder if it doesn't exist
-    try:
-        Path("csv").mkdir()
-    except FileExistsError:
-        pass
-
-    csv_file = Path(f"csv/{num}.csv")
-
-    if csv_file.exists():
-        return FileResponse(csv_file)
-
-    # otherwise, fetch the data from the database
-    try:
-        record = get_record(num)
-    except ValidationError:
-        return JSONResponse(status_code=500, content={"message": "Unexpected data type found."})
-
-    if record is None:
-        return JSONResponse(status_code=404, content={"message": "Record not found"})
-
-    # create CSV, save it, return it
-    with open(csv_file, "w", newline="") as f:
-        # create a writer for the metadata and add it
-        fieldnames_metadata = list(Record.schema()["properties"].keys())
-        # remove the "counts" field from this - that will be written separately
-        fieldnames_metadata.remove("counts")
-
-        writer = csv.DictWriter(f, fieldnames=fieldnames_metadata, extrasaction="ignore")
-        writer.writeheader()
-        writer.writerow(record.dict(by_alias=True))
-
-        # Create new writer, just to write an empty line to the same file
-        writer = csv.writer(f)
-        writer.writerow("")
-
-        # create a new writer for the actual count data, and add it to the same file
-        fieldnames_count = list(Count.schema()["properties"].keys())
-        writer = csv.DictWriter(f, fieldnames=fieldnames_count)
-        writer.writeheader()
-        for count in record.counts:
-            writer.writerow(count.dict(by_alias=True))
-
-    return FileResponse(csv_file)
+    return fetch_record_csv(num, if_none_match)